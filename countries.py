@@ -0,0 +1,42 @@
+"""
+Country and trade-region names recognised without asking the LLM.
+
+Used to vet places parsed from plainly structured questions; anything not listed here
+is left to the LLM extraction prompt. Names are lowercase.
+"""
+from typing import FrozenSet
+
+COUNTRY_NAMES: FrozenSet[str] = frozenset({
+    "afghanistan", "albania", "algeria", "andorra", "angola", "antigua and barbuda", "argentina",
+    "armenia", "australia", "austria", "azerbaijan", "bahamas", "bahrain", "bangladesh", "barbados",
+    "belarus", "belgium", "belize", "benin", "bhutan", "bolivia", "bosnia and herzegovina",
+    "botswana", "brazil", "brunei", "bulgaria", "burkina faso", "burundi", "cabo verde",
+    "cambodia", "cameroon", "canada", "central african republic", "chad", "chile", "china",
+    "colombia", "comoros", "congo", "costa rica", "cote d'ivoire", "côte d'ivoire", "croatia",
+    "cuba", "cyprus", "czechia", "czech republic", "denmark", "djibouti", "dominica",
+    "dominican republic", "ecuador", "egypt", "el salvador", "equatorial guinea", "eritrea",
+    "estonia", "eswatini", "ethiopia", "fiji", "finland", "france", "gabon", "gambia", "georgia",
+    "germany", "ghana", "greece", "grenada", "guatemala", "guinea", "guinea-bissau", "guyana",
+    "haiti", "honduras", "hong kong", "hungary", "iceland", "india", "indonesia", "iran", "iraq",
+    "ireland", "israel", "italy", "ivory coast", "jamaica", "japan", "jordan", "kazakhstan",
+    "kenya", "kiribati", "kosovo", "kuwait", "kyrgyzstan", "laos", "latvia", "lebanon", "lesotho",
+    "liberia", "libya", "liechtenstein", "lithuania", "luxembourg", "macau", "madagascar",
+    "malawi", "malaysia", "maldives", "mali", "malta", "marshall islands", "mauritania",
+    "mauritius", "mexico", "micronesia", "moldova", "monaco", "mongolia", "montenegro", "morocco",
+    "mozambique", "myanmar", "burma", "namibia", "nauru", "nepal", "netherlands", "holland",
+    "new zealand", "nicaragua", "niger", "nigeria", "north korea", "north macedonia", "norway",
+    "oman", "pakistan", "palau", "palestine", "panama", "papua new guinea", "paraguay", "peru",
+    "philippines", "poland", "portugal", "puerto rico", "qatar", "romania", "russia", "rwanda",
+    "saint kitts and nevis", "saint lucia", "samoa", "san marino", "saudi arabia", "senegal",
+    "serbia", "seychelles", "sierra leone", "singapore", "slovakia", "slovenia",
+    "solomon islands", "somalia", "south africa", "south korea", "korea", "south sudan", "spain",
+    "sri lanka", "sudan", "suriname", "sweden", "switzerland", "syria", "taiwan", "tajikistan",
+    "tanzania", "thailand", "timor-leste", "togo", "tonga", "trinidad and tobago", "tunisia",
+    "turkey", "türkiye", "turkmenistan", "tuvalu", "uganda", "ukraine", "united arab emirates",
+    "uae", "united kingdom", "uk", "u.k", "great britain", "britain", "england", "scotland",
+    "wales", "northern ireland", "united states", "usa", "us", "u.s", "u.s.a", "america",
+    "uruguay", "uzbekistan", "vanuatu", "vatican city", "venezuela", "vietnam", "viet nam",
+    "yemen", "zambia", "zimbabwe",
+    # Trade blocs and regions that have their own import rules
+    "eu", "european union", "europe", "eea", "asean", "gcc", "mercosur", "efta",
+})
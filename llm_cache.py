@@ -0,0 +1,138 @@
+import os
+import orjson
+import asyncio
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+from cachetools import LRUCache, TTLCache
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Requests sampled above this temperature are not deterministic enough to cache
+MAX_CACHEABLE_TEMPERATURE = 0.3
+
+def make_cache_key(namespace: str, *parts: Any) -> str:
+    """
+    Build a stable cache key from a namespace and any JSON-serializable parts.
+
+    Args:
+        namespace (str): Prefix identifying the kind of cached call
+        *parts (Any): Values that uniquely identify the call
+
+    Returns:
+        str: The namespaced SHA-256 hex digest of the parts
+    """
+    digest = hashlib.sha256(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return f"{namespace}:{digest}"
+
+def is_cacheable(payload: Dict[str, Any]) -> bool:
+    """
+    Return True if a Perplexity payload is deterministic enough to cache.
+    """
+    return payload.get("temperature", 0) <= MAX_CACHEABLE_TEMPERATURE
+
+class LLMCache:
+    """
+    Async cache for Perplexity responses.
+
+    Entries are kept in an in-process TTL cache by default. Set
+    LLM_CACHE_BACKEND=redis (and optionally REDIS_URL) to share the cache
+    between workers through Redis instead.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = 86_400):
+        self.ttl = ttl
+        self._memory: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._redis = None
+
+        if os.getenv("LLM_CACHE_BACKEND", "memory").lower() == "redis":
+            import redis.asyncio as redis
+            self._redis = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+
+    async def get(self, key: str) -> Optional[Any]:
+        """
+        Return the cached value for key, or None on a miss.
+        """
+        if self._redis is None:
+            return self._memory.get(key)
+
+        try:
+            raw = await self._redis.get(key)
+        except Exception as e:
+            logger.warning("Redis cache lookup failed for %s: %s", key, e)
+            return None
+        return orjson.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any) -> None:
+        """
+        Store value under key for the configured TTL.
+        """
+        if self._redis is None:
+            self._memory[key] = value
+            return
+
+        try:
+            await self._redis.set(key, orjson.dumps(value), ex=self.ttl)
+        except Exception as e:
+            logger.warning("Redis cache write failed for %s: %s", key, e)
+
+class SemanticCache:
+    """
+    Nearest-neighbour cache keyed by sentence embeddings rather than exact text.
+
+    A lookup returns the value stored for the most similar earlier text when its cosine
+    similarity reaches the threshold. Requires the optional sentence-transformers package.
+    """
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", threshold: float = 0.92, maxsize: int = 10_000):
+        import numpy as np
+        from sentence_transformers import SentenceTransformer
+
+        self._np = np
+        self._model = SentenceTransformer(model_name)
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._vectors = np.empty((0, self._model.get_sentence_embedding_dimension()), dtype=np.float32)
+        self._values: List[Any] = []
+        # Embeddings computed by get(), reused by a following set() for the same text
+        self._recent_embeddings: LRUCache = LRUCache(maxsize=1024)
+
+    async def _embed(self, text: str) -> Any:
+        embedding = self._recent_embeddings.get(text)
+        if embedding is None:
+            # Encoding is CPU-bound, so keep it off the event loop
+            loop = asyncio.get_running_loop()
+            embedding = await loop.run_in_executor(
+                None,
+                lambda: self._model.encode(text, normalize_embeddings=True).astype(self._np.float32)
+            )
+            self._recent_embeddings[text] = embedding
+        return embedding
+
+    async def get(self, text: str) -> Optional[Any]:
+        """
+        Return the value stored for the most similar text, or None if nothing is similar enough.
+        """
+        embedding = await self._embed(text)
+        if not self._values:
+            return None
+
+        # Embeddings are normalized, so the dot product is the cosine similarity
+        scores = self._vectors @ embedding
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None
+        return self._values[best]
+
+    async def set(self, text: str, value: Any) -> None:
+        """
+        Store value under the embedding of text, evicting the oldest entry when full.
+        """
+        embedding = await self._embed(text)
+        if len(self._values) >= self.maxsize:
+            self._vectors = self._vectors[1:]
+            self._values.pop(0)
+        self._vectors = self._np.vstack([self._vectors, embedding])
+        self._values.append(value)
@@ -1,10 +1,12 @@
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
-from utils import process_domains, deduplicate_certifications_with_llm
-import time
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from utils import process_domains, deduplicate_certifications_with_llm, get_session, close_session, ExtractionError, MISSING_FIELDS_ERROR
+from postprocess import reformat_results, convert_to_markdown, loads_llm_json
 import json
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,14 +15,38 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Regulatory Certification Search API",
     description="API to search for regulatory certifications using Perplexity AI",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+@app.on_event("startup")
+async def startup_event():
+    """Open the shared Perplexity HTTP session"""
+    await get_session()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the shared Perplexity HTTP session"""
+    await close_session()
+
 class SearchRequest(BaseModel):
-    user_question: str = Field(..., description="User's question to find regulatory certifications, from which product, origin, and destination will be extracted")
-    domains: List[str] = Field(..., min_items=1, description="List of domains to search for regulatory certifications")
+    model_config = ConfigDict(extra="ignore", validate_assignment=False)
+
+    user_question: Optional[str] = Field(None, description="User's question to find regulatory certifications, from which product, origin, and destination will be extracted")
+    product: Optional[str] = Field(None, description="Product to export; overrides the value extracted from user_question")
+    origin: Optional[str] = Field(None, description="Country of origin; overrides the value extracted from user_question")
+    destination: Optional[str] = Field(None, description="Destination country or region; overrides the value extracted from user_question")
+    domains: List[str] = Field(..., min_length=1, description="List of domains to search for regulatory certifications")
+
+    @model_validator(mode="after")
+    def check_search_target(self) -> "SearchRequest":
+        if not self.user_question and not (self.product and self.origin and self.destination):
+            raise ValueError("Provide either user_question or all of product, origin, and destination")
+        return self
 
 class CertificationResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore", validate_assignment=False)
+
     certificate_name: str
     certificate_description: str
     legal_regulation: str
@@ -28,88 +54,82 @@ class CertificationResponse(BaseModel):
     legal_text_meaning: str
     registration_fee: str
 
-def reformat_results(data: Dict[str, Any]) -> List[Dict[str, Any]]:
-    combined_certifications = []
-    results = data.get("results", [])
-
-    for entry in results:
-        domain = entry.get("domain")
-        response_content = (
-            entry.get("response", {})
-                 .get("choices", [{}])[0]
-                 .get("message", {})
-                 .get("content")
+async def _do_search(request: SearchRequest) -> Dict[str, Any]:
+    """
+    Run the search pipeline shared by the /search endpoints.
+    """
+    start_time = time.time()  # Start timer
+    if not request.domains:
+        raise HTTPException(status_code=400, detail="No domains provided")
+        
+    if request.user_question:
+        logger.info("Processing request for user question: %s", request.user_question)
+    else:
+        logger.info("Processing request for %s from %s to %s", request.product, request.origin, request.destination)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Processing %d domains: %s", len(request.domains), ', '.join(request.domains))
+    
+    try:
+        results = await process_domains(
+            domains=request.domains,
+            user_question=request.user_question,
+            product=request.product,
+            origin=request.origin,
+            destination=request.destination
         )
+    except ExtractionError as e:
+        # Perplexity failed, not the caller: 503 if it is rate limiting us, 502 otherwise
+        raise HTTPException(status_code=503 if e.status == 429 else 502, detail=f"Could not extract fields from user question: {e}")
+    
+    # Nothing was queried, so ask the caller to clarify rather than returning no results
+    if all(result.get("error") == MISSING_FIELDS_ERROR for result in results):
+        raise HTTPException(status_code=422, detail=f"{results[0]['details']} from user question; provide product, origin, and destination explicitly")
 
-        if response_content:
-            try:
-                certs_from_domain = json.loads(response_content)
-                if isinstance(certs_from_domain, list):
-                    for cert in certs_from_domain:
-                        cert['domain'] = domain  # Add domain to each cert
-                        combined_certifications.append(cert)
-                elif isinstance(certs_from_domain, dict) and "error" in certs_from_domain:
-                    logger.warning(f"Domain {domain} returned an error in content: {certs_from_domain.get('message', '')}")
-                else:
-                    logger.warning(f"Unexpected content format from domain {domain}: {response_content[:100]}...")
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON from domain {domain} content: {response_content[:100]}...")
-        elif "error" in entry:
-            logger.error(f"Top-level error for domain {domain}: {entry.get('details', '')}")
+    elapsed = time.time() - start_time  # End timer
+    logger.info("Total time taken for /search: %.2f seconds", elapsed)
+    
+    # Log successful results and any errors; the content is only parsed for logging when INFO is enabled
+    log_successes = logger.isEnabledFor(logging.INFO)
+    for result in results:
+        if "error" not in result:
+            if not log_successes:
+                continue
+            logger.info("Successfully processed domain: %s", result['domain'])
+            if "response" in result and "choices" in result["response"]:
+                # Log length of choices in response, not response itself
+                content = result['response']['choices'][0]['message']['content']
+                try:
+                    parsed_content = loads_llm_json(content, "[")
+                    if isinstance(parsed_content, list):
+                        logger.info("Found %d certification requirements for %s", len(parsed_content), result['domain'])
+                    else:
+                        logger.info("Domain %s returned non-list content.", result['domain'])
+                except json.JSONDecodeError:
+                    logger.info("Domain %s returned non-JSON content.", result['domain'])
+        else:
+            logger.error("Failed to process domain %s: %s", result['domain'], result['error'])
+            if "details" in result:
+                logger.error("Error details: %s", result['details'])
+    
+    # Reformat the results using the new logic
+    formatted_results = reformat_results({"results": results})
+    
+    # Deduplicate the results using LLM
+    deduplicated_results = await deduplicate_certifications_with_llm(formatted_results)
 
-    return combined_certifications
+    return {
+        "elapsed_seconds": round(elapsed, 2),
+        "results": deduplicated_results
+    }
 
 @app.post("/search")
 async def search_certifications(request: SearchRequest) -> Dict[str, Any]:
-    start_time = time.time()  # Start timer
     try:
-        if not request.domains:
-            raise HTTPException(status_code=400, detail="No domains provided")
-            
-        logger.info(f"Processing request for user question: {request.user_question}")
-        logger.info(f"Processing {len(request.domains)} domains: {', '.join(request.domains)}")
-        
-        results = await process_domains(
-            domains=request.domains,
-            user_question=request.user_question
-        )
-        
-        elapsed = time.time() - start_time  # End timer
-        logger.info(f"Total time taken for /search: {elapsed:.2f} seconds")
-        
-        # Log successful results and any errors
-        for result in results:
-            if "error" not in result:
-                logger.info(f"Successfully processed domain: {result['domain']}")
-                if "response" in result and "choices" in result["response"]:
-                    # Log length of choices in response, not response itself
-                    content = result['response']['choices'][0]['message']['content']
-                    try:
-                        parsed_content = json.loads(content)
-                        if isinstance(parsed_content, list):
-                            logger.info(f"Found {len(parsed_content)} certification requirements for {result['domain']}")
-                        else:
-                            logger.info(f"Domain {result['domain']} returned non-list content.")
-                    except json.JSONDecodeError:
-                        logger.info(f"Domain {result['domain']} returned non-JSON content.")
-            else:
-                logger.error(f"Failed to process domain {result['domain']}: {result['error']}")
-                if "details" in result:
-                    logger.error(f"Error details: {result['details']}")
-        
-        # Reformat the results using the new logic
-        formatted_results = reformat_results({"results": results})
-        
-        # Deduplicate the results using LLM
-        deduplicated_results = await deduplicate_certifications_with_llm(formatted_results)
-
-        return {
-            "elapsed_seconds": round(elapsed, 2),
-            "results": deduplicated_results
-        }
-        
+        return await _do_search(request)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}")
+        logger.error("Error processing request: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/health")
@@ -117,39 +137,14 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy"}
 
-def convert_to_markdown(certifications: List[Dict[str, Any]]) -> str:
-    """
-    Convert certification results to markdown format.
-    
-    Args:
-        certifications (List[Dict[str, Any]]): List of certification requirements
-        
-    Returns:
-        str: Markdown formatted string
-    """
-    markdown = "# Required Certifications and Regulatory Requirements\n\n"
-    
-    # Generate markdown for each certification sequentially
-    for i, cert in enumerate(certifications, 1):
-        markdown += f"## {i}. {cert['certificate_name']}\n\n"
-        markdown += f"**Source Domain:** {cert['domain']}\n\n"
-        markdown += f"**Description:** {cert['certificate_description']}\n\n"
-        markdown += f"**Legal Regulation:** {cert['legal_regulation']}\n\n"
-        markdown += f"**Legal Text Excerpt:**\n> {cert['legal_text_excerpt']}\n\n"
-        markdown += f"**Legal Text Meaning:** {cert['legal_text_meaning']}\n\n"
-        markdown += f"**Registration Fee:** {cert['registration_fee']}\n\n"
-        markdown += "---\n\n"
-    
-    return markdown
-
 @app.post("/search/markdown")
 async def search_certifications_markdown(request: SearchRequest) -> Dict[str, Any]:
     """
     Search for certifications and return results in markdown format.
     """
     try:
-        # First get the regular search results
-        search_results = await search_certifications(request)
+        # First run the regular search pipeline
+        search_results = await _do_search(request)
         
         # Convert the results to markdown
         markdown_content = convert_to_markdown(search_results["results"])
@@ -159,6 +154,8 @@ async def search_certifications_markdown(request: SearchRequest) -> Dict[str, An
             "markdown": markdown_content
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing markdown request: {str(e)}")
+        logger.error("Error processing markdown request: %s", e)
         raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
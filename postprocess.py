@@ -0,0 +1,178 @@
+"""
+Pure post-processing of search results and the LLM replies they contain.
+
+Kept free of I/O and fully annotated so it can be compiled with mypyc
+(`mypyc postprocess.py`) without changing any callers.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import re
+from typing import List, Dict, Any, Optional, Tuple
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# The only characters that change the scanner's state: brackets of the kind being
+# matched, string quotes, and backslash escapes
+_JSON_SCAN_PATTERNS = {
+    "{": re.compile(r'[{}"\\]'),
+    "[": re.compile(r'[\[\]"\\]'),
+}
+
+def find_first_json(content: str, opener: str, start: int = 0) -> Optional[Tuple[int, int]]:
+    """
+    Find the first balanced JSON object or array in content at or after start.
+
+    Brackets inside string literals are ignored, so prose around the JSON and braces in quoted
+    legal text don't shift the boundaries. The span is not validated as JSON.
+
+    Args:
+        content (str): The text to scan
+        opener (str): "{" to look for an object, "[" to look for an array
+        start (int): Index to start scanning from
+
+    Returns:
+        Optional[Tuple[int, int]]: The (start, end) slice of the value, or None if no opener is
+        found or the brackets after it never balance
+    """
+    begin = content.find(opener, start)
+    if begin == -1:
+        return None
+
+    closer = "}" if opener == "{" else "]"
+    depth = 0
+    in_string = False
+    escaped_index = -1
+    for match in _JSON_SCAN_PATTERNS[opener].finditer(content, begin):
+        index = match.start()
+        if index == escaped_index:
+            continue
+        char = match.group()
+        if in_string:
+            if char == "\\":
+                escaped_index = index + 1
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == opener:
+            depth += 1
+        elif char == closer:
+            depth -= 1
+            if depth == 0:
+                return begin, index + 1
+    return None
+
+# Stdlib decoder used only for raw_decode, which orjson has no equivalent of
+_json_decoder = json.JSONDecoder()
+
+def loads_llm_json(content: Any, opener: str) -> Any:
+    """
+    Parse the JSON in an LLM reply.
+
+    The whole reply is parsed directly first, since models usually return bare JSON. If that fails,
+    the first balanced span found by find_first_json that parses is returned, so prose around the
+    JSON is skipped. Replies whose brackets never balance fall back to trying raw_decode at each
+    opener character.
+
+    Args:
+        content (Any): The message content returned by the model; anything but a string is rejected
+        opener (str): "{" to look for an object, "[" to look for an array
+
+    Returns:
+        Any: The decoded JSON value
+
+    Raises:
+        json.JSONDecodeError: If content is not a string or no parsable JSON is found
+    """
+    if not isinstance(content, str):
+        raise json.JSONDecodeError("LLM reply content is not a string", "", 0)
+
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError as e:
+        error = e
+
+    span = find_first_json(content, opener)
+    while span is not None:
+        try:
+            return orjson.loads(content[span[0]:span[1]])
+        except orjson.JSONDecodeError:
+            span = find_first_json(content, opener, span[0] + 1)
+
+    start = content.find(opener)
+    while start != -1:
+        try:
+            value, _ = _json_decoder.raw_decode(content, start)
+            return value
+        except json.JSONDecodeError:
+            start = content.find(opener, start + 1)
+    raise error
+
+def reformat_results(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Flatten per-domain Perplexity results into a single list of certifications.
+
+    Args:
+        data (Dict[str, Any]): Mapping with a "results" list as returned by process_domains
+
+    Returns:
+        List[Dict[str, Any]]: Certifications from every domain, each tagged with its source domain
+    """
+    combined_certifications: List[Dict[str, Any]] = []
+    results = data.get("results", [])
+
+    for entry in results:
+        domain = entry.get("domain")
+        try:
+            response_content = entry["response"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            response_content = None
+
+        if response_content:
+            try:
+                certs_from_domain = loads_llm_json(response_content, "[")
+                if isinstance(certs_from_domain, list):
+                    # Add domain to each cert
+                    combined_certifications.extend({**cert, "domain": domain} for cert in certs_from_domain)
+                elif isinstance(certs_from_domain, dict) and "error" in certs_from_domain:
+                    logger.warning("Domain %s returned an error in content: %s", domain, certs_from_domain.get('message', ''))
+                else:
+                    logger.warning("Unexpected content format from domain %s: %.100s...", domain, response_content)
+            except json.JSONDecodeError:
+                logger.error("Failed to decode JSON from domain %s content: %.100s...", domain, response_content)
+        elif "error" in entry:
+            logger.error("Top-level error for domain %s: %s", domain, entry.get('details', ''))
+
+    return combined_certifications
+
+MARKDOWN_HEADER = "# Required Certifications and Regulatory Requirements\n\n"
+MARKDOWN_CERT_TEMPLATE = (
+    "## {index}. {certificate_name}\n\n"
+    "**Source Domain:** {domain}\n\n"
+    "**Description:** {certificate_description}\n\n"
+    "**Legal Regulation:** {legal_regulation}\n\n"
+    "**Legal Text Excerpt:**\n> {legal_text_excerpt}\n\n"
+    "**Legal Text Meaning:** {legal_text_meaning}\n\n"
+    "**Registration Fee:** {registration_fee}\n\n"
+    "---\n\n"
+)
+
+def convert_to_markdown(certifications: List[Dict[str, Any]]) -> str:
+    """
+    Convert certification results to markdown format.
+    
+    Args:
+        certifications (List[Dict[str, Any]]): List of certification requirements
+        
+    Returns:
+        str: Markdown formatted string
+    """
+    parts = [MARKDOWN_HEADER]
+    parts.extend(
+        MARKDOWN_CERT_TEMPLATE.format_map({**cert, "index": i})
+        for i, cert in enumerate(certifications, 1)
+    )
+    return "".join(parts)
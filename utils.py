@@ -2,100 +2,554 @@ import os
 import logging
 import aiohttp
 import asyncio
+import re
 import json
-from typing import List, Dict, Any
-from dotenv import load_dotenv
+import socket
+import time
+import orjson
+from typing import List, Dict, Any, Optional, Set, Tuple, Callable, Awaitable, AsyncIterator
+from aiolimiter import AsyncLimiter
+from yarl import URL
+from tenacity import RetryCallState, retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from llm_cache import LLMCache, SemanticCache, make_cache_key, is_cacheable
+from postprocess import loads_llm_json
+from countries import COUNTRY_NAMES
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
+# Fall back to a .env file only when the environment (e.g. docker or systemd) doesn't provide the key
 PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
+if not PERPLEXITY_API_KEY:
+    from dotenv import load_dotenv
+    load_dotenv()
+    PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
 if not PERPLEXITY_API_KEY:
     raise ValueError("PERPLEXITY_API_KEY environment variable is not set")
 
+PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
+
+# Maximum concurrent Perplexity calls across all searches, domains
+# answered per call (0 sends every domain of a search in a single call),
+# attempts per call on 429/5xx/network errors, and the longest Retry-After
+# (seconds) that will be honored
+PPLX_CONCURRENCY = int(os.getenv("PERPLEXITY_MAX_CONCURRENCY", os.getenv("PPLX_CONCURRENCY", "64")))
+PPLX_BATCH_SIZE = int(os.getenv("PPLX_BATCH_SIZE", "10"))
+MAX_RETRIES = 4
+MAX_RETRY_AFTER = 60
+
+# Error reported for every domain when a search can't name product, origin, and destination
+MISSING_FIELDS_ERROR = "Missing product, origin, or destination"
+
+# Requests-per-minute quota enforced before every outbound Perplexity call
+PPLX_RPM = int(os.getenv("PPLX_RPM", "50"))
+_rate_limiter = AsyncLimiter(PPLX_RPM, 60)
+
+PERPLEXITY_HEADERS = {
+    "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
+    "Content-Type": "application/json",
+    # aiohttp decodes both transparently; brotli needs the Brotli package installed
+    "Accept-Encoding": "br, gzip"
+}
+
+EXTRACTION_SYSTEM_PROMPT = (
+    "You are a helpful assistant specialized in extracting structured information from user questions. "
+    "Your task is to extract the following fields **only if clearly mentioned or confidently implied**:\n"
+    "- product: the item the user wants to export\n"
+    "- origin: the country where the product is made or shipped from\n"
+    "- destination: the country or region where the product will be sold or exported to\n\n"
+    "If a country is not mentioned but a company (e.g., 'Nike', 'The North Face') is mentioned, "
+    "you may infer the country of operation **only if it is widely known and unambiguous**. "
+    "If you're unsure about any field, leave it as an empty string.\n\n"
+    "Return ONLY a valid JSON object with exactly these keys: 'product', 'origin', 'destination'. "
+    "Do NOT include any extra commentary, explanation, or markdown. "
+    "Do NOT generate data that is not present or confidently inferable."
+)
+EXTRACTION_USER_PROMPT_TEMPLATE = (
+    "The following is a user's question about exporting a product. "
+    "Please extract the three key fields: 'product', 'origin', and 'destination'. "
+    "If any of them are not clearly stated or confidently implied, leave them as an empty string.\n\n"
+    "User question:\n{user_question}\n\n"
+    "Return ONLY a valid JSON object with the keys: 'product', 'origin', 'destination'."
+)
+
+# Shared by the per-domain and batched certification queries. Everything that is
+# the same on every call comes first and the per-search values are appended at
+# the end, so the provider's prompt-prefix cache can reuse the invariant part;
+# keep that prefix byte-identical between calls.
+CERTIFICATION_SYSTEM_PROMPT = "You are a global trade compliance assistant. Respond only with official and verifiable regulatory data from trusted sources (e.g., Eur-Lex, FDA, DGFT, WTO, etc.). Format your response strictly as JSON. Do not include commentary, markdown, or assumptions. Only output the final structured JSON."
+CERTIFICATION_PROMPT_HEAD = (
+    "Identify all certifications, licenses, and regulatory approvals required to legally export the product given below from its origin and sell or distribute it in its destination. For each requirement, return the following fields:\n"
+    "- certificate_name: The name of the certification or license\n"
+    "- certificate_description: A short explanation of what the certificate is and why it's required\n"
+    "- legal_regulation: The name and article of the law or directive that mandates this (e.g., Regulation (EC) No 1223/2009, Article 19)\n"
+    "- legal_text_excerpt: An exact quote (1–2 lines) from the regulation\n"
+    "- legal_text_meaning: A simplified explanation of the quoted text\n"
+    "- registration_fee: The official registration or filing fee, if publicly available (include currency and link if possible and convert to approximate USD (e.g., 'INR 500 (~$6.00 USD)'))\n"
+)
+CERTIFICATION_SEARCH_PROMPT = "\n\nPRODUCT: {product}\nORIGIN: {origin}\nDESTINATION: {destination}"
+CERTIFICATION_USER_PROMPT_TEMPLATE = (
+    CERTIFICATION_PROMPT_HEAD
+    + "Return the result as a JSON array using exactly these field names: certificate_name, certificate_description, legal_regulation, legal_text_excerpt, legal_text_meaning, registration_fee"
+    + CERTIFICATION_SEARCH_PROMPT
+)
+BATCH_CERTIFICATION_USER_PROMPT_TEMPLATE = (
+    CERTIFICATION_PROMPT_HEAD
+    + "Answer separately for each of the source domains given below, using only that domain. Return the result as a JSON object whose keys are the source domains exactly as given below and whose values are JSON arrays of requirements using exactly these field names: certificate_name, certificate_description, legal_regulation, legal_text_excerpt, legal_text_meaning, registration_fee"
+    + CERTIFICATION_SEARCH_PROMPT
+    + "\nSOURCE DOMAINS: {domains}"
+)
+
+DEDUPLICATION_SYSTEM_PROMPT = "You are an expert in regulatory compliance and data consolidation. Your task is to review a list of certification requirements, identify and consolidate similar or duplicate certifications based on their 'certificate_name' and 'certificate_description'. For each unique certification, provide one comprehensive entry. If there are variations for the same certificate, use the most detailed and representative information. Ensure the output is a JSON array of unique certification objects, maintaining all original field names: 'certificate_name', 'certificate_description', 'legal_regulation', 'legal_text_excerpt', 'legal_text_meaning', 'registration_fee', and 'domain'. Do not include any other text, commentary, or markdown outside the JSON."
+DEDUPLICATION_USER_PROMPT_TEMPLATE = "Here is the list of certifications:\n\n{certifications}\n\nConsolidate and return only the unique certifications."
+
+# Payload fields and system messages that are the same on every call; only the
+# user message is built per call. These are shared, so never mutate them.
+EXTRACTION_PAYLOAD_BASE = {"model": "sonar-pro", "temperature": 0.1, "include_search_results": False}
+CERTIFICATION_PAYLOAD_BASE = {"model": "sonar-pro", "temperature": 0.2}
+DEDUPLICATION_PAYLOAD_BASE = {"model": "sonar-pro", "temperature": 0.1, "include_search_results": False} # Keep temperature low for more deterministic results
+EXTRACTION_SYSTEM_MESSAGE = {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT}
+CERTIFICATION_SYSTEM_MESSAGE = {"role": "system", "content": CERTIFICATION_SYSTEM_PROMPT}
+DEDUPLICATION_SYSTEM_MESSAGE = {"role": "system", "content": DEDUPLICATION_SYSTEM_PROMPT}
+
+# Shared HTTP session so keep-alive connections to Perplexity are pooled
+# across calls instead of paying a new TCP+TLS handshake every time.
+# aiohttp speaks HTTP/1.1 only, so concurrent calls each hold their own pooled
+# connection rather than multiplexing over HTTP/2; long keep-alive plus domain
+# batching keep the number of handshakes per search low.
+_session: Optional[aiohttp.ClientSession] = None
+
+def _make_resolver() -> aiohttp.abc.AbstractResolver:
+    """
+    Return an aiodns-backed resolver if aiodns is installed, else aiohttp's thread-pool getaddrinfo resolver.
+    """
+    try:
+        import aiodns  # noqa: F401
+    except ImportError:
+        return aiohttp.ThreadedResolver()
+    return aiohttp.AsyncResolver()
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Return the shared aiohttp session, creating it on first use.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=1000,
+                limit_per_host=100,
+                # Resolve api.perplexity.ai at most every five minutes, IPv4 only,
+                # so cold connections skip dual-stack fallback attempts
+                use_dns_cache=True,
+                ttl_dns_cache=300,
+                family=socket.AF_INET,
+                resolver=_make_resolver(),
+                keepalive_timeout=300,
+                enable_cleanup_closed=True
+            ),
+            # Fail fast on unreachable hosts without cutting off slow completions
+            timeout=aiohttp.ClientTimeout(total=60, connect=10)
+        )
+    return _session
+
+async def close_session() -> None:
+    """
+    Close the shared aiohttp session if it has been created.
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+async def _warm_connection() -> None:
+    """
+    Open a keep-alive connection to the Perplexity API so a later call can reuse it from the pool.
+    """
+    try:
+        session = await get_session()
+        async with session.head(str(URL(PERPLEXITY_API_URL).origin()), timeout=aiohttp.ClientTimeout(total=5)):
+            pass
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug("Perplexity connection warmup failed: %s", e)
+
+def warm_connections(count: int) -> None:
+    """
+    Start opening count pooled connections to the Perplexity API in the background.
+
+    Used to hide DNS, TCP and TLS setup for upcoming domain queries behind other work.
+    """
+    for _ in range(min(count, PPLX_CONCURRENCY)):
+        task = asyncio.create_task(_warm_connection())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+# Created on first use so it binds to the server's event loop
+_query_semaphore: Optional[asyncio.Semaphore] = None
+
+def _get_query_semaphore() -> asyncio.Semaphore:
+    """
+    Return the process-wide semaphore that caps in-flight Perplexity calls.
+    """
+    global _query_semaphore
+    if _query_semaphore is None:
+        _query_semaphore = asyncio.Semaphore(PPLX_CONCURRENCY)
+    return _query_semaphore
+
+# Response cache shared by all Perplexity helpers. Regulatory requirements change
+# rarely, so entries are kept for a week. Bump PROMPT_VERSION whenever a prompt
+# changes so entries produced by the old prompt are not reused.
+PROMPT_VERSION = "v2"
+_cache = LLMCache(ttl=7 * 86_400)
+
+# Optional embedding-similarity cache for question extraction, so rephrasings of
+# an earlier question skip the LLM too. Entries are (normalized question, extraction)
+# pairs so a hit can be checked against the question it was extracted from.
+# Needs sentence-transformers.
+_semantic_cache: Optional[SemanticCache] = (
+    SemanticCache() if os.getenv("SEMANTIC_CACHE", "").lower() in ("1", "true", "yes") else None
+)
+
+# Plainly structured questions such as "Export honey from India to USA" are parsed
+# without a Perplexity call. Places are limited to one to three words, none of them a
+# connective, so anything with a trailing clause ("... to USA for retail sale") or
+# several countries ("... to the USA and Canada") is left to the LLM, as is any place
+# not in COUNTRY_NAMES.
+_PLACE_WORD = r"(?!(?:and|or|for|with|via|by|in|under|using|through|from|to|the)\b)[a-z][a-z'-]*(?:\.[a-z]+)*"
+_PLACE = rf"{_PLACE_WORD}(?:\s+{_PLACE_WORD}){{0,2}}"
+SIMPLE_QUESTION_PATTERN = re.compile(
+    rf"^\s*(?:export|ship)\s+(?P<product>[^,?]+?)\s+from\s+(?:the\s+)?(?P<origin>{_PLACE})"
+    rf"\s+to\s+(?:the\s+)?(?P<destination>{_PLACE})\s*[?.!]?\s*$",
+    re.IGNORECASE
+)
+
+# Size of each read from a Perplexity response body
+READ_CHUNK_SIZE = 1 << 16
+
+async def read_json(response: aiohttp.ClientResponse) -> Any:
+    """
+    Read a JSON response body in fixed-size chunks and parse it with orjson.
+
+    Args:
+        response (aiohttp.ClientResponse): The response to read
+
+    Returns:
+        Any: The decoded JSON body
+    """
+    buf = bytearray()
+    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+        buf.extend(chunk)
+    return orjson.loads(buf)
+
+def normalize_question(user_question: str) -> str:
+    """
+    Normalize a user question for cache lookups by lowercasing it and collapsing whitespace.
+    """
+    return " ".join(user_question.lower().split())
+
+def normalize_domain(domain: str) -> str:
+    """
+    Normalize a domain for comparison by lowercasing it and dropping any scheme, leading "www." and trailing slashes.
+    """
+    domain = domain.strip().lower()
+    domain = domain.split("://", 1)[-1].rstrip("/")
+    return domain[4:] if domain.startswith("www.") else domain
+
+def _split_batch_reply(certs_by_domain: Any, domains: List[str]) -> Optional[Dict[str, List[Any]]]:
+    """
+    Map each requested domain to its certifications from a batched reply.
+
+    The model may key the reply slightly differently from the request (e.g. "https://www.fda.gov"),
+    so keys are compared after normalize_domain. Returns None unless every requested domain is
+    present with a list value.
+    """
+    if not isinstance(certs_by_domain, dict):
+        return None
+
+    normalized = {normalize_domain(str(key)): value for key, value in certs_by_domain.items()}
+    split: Dict[str, List[Any]] = {}
+    for domain in domains:
+        certs = normalized.get(normalize_domain(domain))
+        if not isinstance(certs, list):
+            return None
+        split[domain] = certs
+    return split
+
+def _matches_cached_extraction(normalized_question: str, cached_question: str, extracted_info: Dict[str, str]) -> bool:
+    """
+    Return True if an extraction cached for cached_question also holds for normalized_question.
+
+    Guards semantic cache hits: questions that differ only in a country, or only in which country
+    is the origin and which the destination, embed almost identically but must not share an
+    extraction. Every non-empty extracted field has to appear in the new question, and origin and
+    destination have to appear in the same order as in the cached question.
+    """
+    if not all(value.lower() in normalized_question for value in extracted_info.values() if value):
+        return False
+
+    origin = extracted_info.get("origin", "").lower()
+    destination = extracted_info.get("destination", "").lower()
+    if not origin or not destination or origin == destination:
+        return True
+
+    cached_origin = cached_question.find(origin)
+    cached_destination = cached_question.find(destination)
+    if cached_origin == -1 or cached_destination == -1:
+        return False
+    return (normalized_question.find(origin) < normalized_question.find(destination)) == (cached_origin < cached_destination)
+
+class ExtractionError(Exception):
+    """
+    Raised when Perplexity can't be reached or fails while extracting fields from a question.
+
+    Distinguishes an upstream failure from a question that simply doesn't name the fields.
+    """
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
 async def extract_info_from_question(user_question: str) -> Dict[str, str]:
     """
     Extracts product, origin, and destination from a user question using Perplexity AI.
+
+    Fields the question doesn't clearly name are returned as empty strings.
+
+    Raises:
+        ExtractionError: If the Perplexity call fails or returns a malformed response
     """
-    url = "https://api.perplexity.ai/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    match = SIMPLE_QUESTION_PATTERN.match(user_question)
+    # Only trust the shortcut for recognised countries; "my farm" or "Nike" need the LLM's judgement
+    if match and match["origin"].lower() in COUNTRY_NAMES and match["destination"].lower() in COUNTRY_NAMES:
+        logger.info("Parsed user question without calling Perplexity")
+        return match.groupdict()
 
     payload = {
-        "model": "sonar-pro",
-        "temperature": 0.1,
+        **EXTRACTION_PAYLOAD_BASE,
         "messages": [
-            {
-                "role": "system",
-                "content": (
-                    "You are a helpful assistant specialized in extracting structured information from user questions. "
-                    "Your task is to extract the following fields **only if clearly mentioned or confidently implied**:\n"
-                    "- product: the item the user wants to export\n"
-                    "- origin: the country where the product is made or shipped from\n"
-                    "- destination: the country or region where the product will be sold or exported to\n\n"
-                    "If a country is not mentioned but a company (e.g., 'Nike', 'The North Face') is mentioned, "
-                    "you may infer the country of operation **only if it is widely known and unambiguous**. "
-                    "If you're unsure about any field, leave it as an empty string.\n\n"
-                    "Return ONLY a valid JSON object with exactly these keys: 'product', 'origin', 'destination'. "
-                    "Do NOT include any extra commentary, explanation, or markdown. "
-                    "Do NOT generate data that is not present or confidently inferable."
+            EXTRACTION_SYSTEM_MESSAGE,
+            {"role": "user", "content": EXTRACTION_USER_PROMPT_TEMPLATE.format(user_question=user_question)}
+        ]
+    }
+
+    use_cache = is_cacheable(payload)
+    if use_cache:
+        normalized_question = normalize_question(user_question)
+        cache_key = make_cache_key("extract", PROMPT_VERSION, payload["model"], normalized_question)
+        cached = await _cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached extraction for user question")
+            return cached
+
+        if _semantic_cache is not None:
+            similar = await _semantic_cache.get(normalized_question)
+            if similar is not None:
+                cached_question, similar_info = similar
+                if _matches_cached_extraction(normalized_question, cached_question, similar_info):
+                    logger.info("Using cached extraction from a similar user question")
+                    return similar_info
+
+    async def fetch() -> Dict[str, str]:
+        try:
+            status, result = await _post_perplexity(payload, "info extraction")
+        except Exception as e:
+            logger.error("Exception while extracting info from user question: %s", e)
+            raise ExtractionError(f"Perplexity request failed: {e}") from e
+
+        if status != 200:
+            logger.error("Error querying Perplexity API for info extraction: %s", result)
+            raise ExtractionError(f"Perplexity API request failed with status {status}", status)
+
+        try:
+            response_content = result["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            logger.error("Malformed Perplexity extraction response: %s", result)
+            raise ExtractionError("Perplexity returned a malformed response", status) from e
+
+        # A reply without usable JSON means the model couldn't name the fields
+        try:
+            extracted_data = loads_llm_json(response_content, "{")
+        except json.JSONDecodeError:
+            extracted_data = None
+
+        if not isinstance(extracted_data, dict):
+            logger.error("No JSON object found in Perplexity extraction response: %s", response_content)
+            return {"product": "", "origin": "", "destination": ""}
+
+        extracted_info = {
+            "product": extracted_data.get("product", ""),
+            "origin": extracted_data.get("origin", ""),
+            "destination": extracted_data.get("destination", "")
+        }
+        # Don't memoize incomplete extractions; a retry may do better
+        if use_cache and all(extracted_info.values()):
+            await _cache.set(cache_key, extracted_info)
+            if _semantic_cache is not None:
+                await _semantic_cache.set(normalized_question, (normalized_question, extracted_info))
+        return extracted_info
+
+    if not use_cache:
+        return await fetch()
+    # Concurrent callers asking the same question share one extraction, including its cache writes
+    return await _single_flight(cache_key, fetch)
+
+# Perplexity calls and cached lookups currently in flight, keyed by payload hash or cache key
+_inflight: Dict[str, asyncio.Task] = {}
+
+async def _single_flight(key: str, coro_factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run coro_factory() at most once at a time per key.
+
+    Concurrent callers with a key that is already in flight await the first caller's result
+    instead of starting their own call. The call runs in its own task, so cancelling any
+    caller, including the one that started it, leaves the others unaffected.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(coro_factory())
+        _inflight[key] = task
+
+        def forget(done: asyncio.Task) -> None:
+            if _inflight.get(key) is done:
+                del _inflight[key]
+            if not done.cancelled():
+                done.exception()  # Mark as retrieved in case every caller was cancelled
+
+        task.add_done_callback(forget)
+
+    # Shield so a cancelled caller doesn't cancel the shared call
+    return await asyncio.shield(task)
+
+async def _post_perplexity(payload: Dict[str, Any], label: str) -> Tuple[int, Any]:
+    """
+    POST a payload to the Perplexity API, sharing the call with any identical payload already in flight.
+
+    Args:
+        payload (Dict[str, Any]): The chat completion payload
+        label (str): Description of the call used in log messages
+
+    Returns:
+        Tuple[int, Any]: The HTTP status and the parsed JSON body on 200, or the raw error text otherwise
+    """
+    return await _single_flight(
+        make_cache_key("inflight", payload),
+        lambda: _send_perplexity(payload, label)
+    )
+
+class RetryableStatusError(Exception):
+    """
+    Raised for Perplexity responses worth retrying: HTTP 429 and 5xx.
+    """
+
+    def __init__(self, status: int, text: str, retry_after: Optional[float] = None):
+        super().__init__(f"API request failed with status {status}")
+        self.status = status
+        self.text = text
+        self.retry_after = retry_after
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Return the delay in seconds from a Retry-After header, or None if it is missing or not numeric.
+    """
+    try:
+        return min(float(value), MAX_RETRY_AFTER) if value is not None else None
+    except ValueError:
+        return None
+
+_exponential_backoff = wait_exponential_jitter(initial=1, max=10)
+
+def _retry_wait(retry_state: RetryCallState) -> float:
+    """
+    Wait as long as the server's Retry-After asks, falling back to exponential backoff with jitter.
+    """
+    error = retry_state.outcome.exception()
+    if isinstance(error, RetryableStatusError) and error.retry_after is not None:
+        return error.retry_after
+    return _exponential_backoff(retry_state)
+
+def _log_retry(retry_state: RetryCallState) -> None:
+    """
+    Log a failed Perplexity attempt before tenacity sleeps and retries it.
+    """
+    logger.warning(
+        "Perplexity call for %s failed (%s), retrying in %.1fs",
+        retry_state.args[1], retry_state.outcome.exception(), retry_state.next_action.sleep
+    )
+
+@retry(
+    stop=stop_after_attempt(MAX_RETRIES),
+    wait=_retry_wait,
+    retry=retry_if_exception_type((RetryableStatusError, aiohttp.ClientError, asyncio.TimeoutError)),
+    before_sleep=_log_retry,
+    reraise=True
+)
+async def _send_perplexity_attempt(payload: Dict[str, Any], label: str) -> Tuple[int, Any]:
+    session = await get_session()
+    # Cap in-flight Perplexity calls across concurrent searches so bursts don't trigger rate
+    # limiting. Held per attempt, so batch fallbacks can't multiply it and backoff sleeps release it.
+    async with _get_query_semaphore():
+        await _rate_limiter.acquire()
+        started_ns = time.perf_counter_ns()
+        async with session.post(PERPLEXITY_API_URL, data=orjson.dumps(payload), headers=PERPLEXITY_HEADERS) as response:
+            if response.status == 200:
+                body = await read_json(response)
+                logger.debug(
+                    "Perplexity call for %s took %.1f ms (Content-Encoding: %s, usage: %s)",
+                    label, (time.perf_counter_ns() - started_ns) / 1e6,
+                    response.headers.get("Content-Encoding", "identity"), body.get("usage")
                 )
-            },
-            {
-                "role": "user",
-                "content": (
-                    f"The following is a user's question about exporting a product. "
-                    f"Please extract the three key fields: 'product', 'origin', and 'destination'. "
-                    f"If any of them are not clearly stated or confidently implied, leave them as an empty string.\n\n"
-                    f"User question:\n{user_question}\n\n"
-                    f"Return ONLY a valid JSON object with the keys: 'product', 'origin', 'destination'."
+                return response.status, body
+            if response.status == 429:
+                # Everything needed is in the headers; the retry waits out Retry-After anyway,
+                # so dropping the connection unread costs less than downloading the body
+                raise RetryableStatusError(
+                    response.status,
+                    response.reason or "Too Many Requests",
+                    _parse_retry_after(response.headers.get("Retry-After"))
                 )
-            }
-        ],
-        "include_search_results": False
-    }
+            if response.status >= 500:
+                raise RetryableStatusError(
+                    response.status,
+                    await response.text(),
+                    _parse_retry_after(response.headers.get("Retry-After"))
+                )
+            return response.status, await response.text()
 
+async def _send_perplexity(payload: Dict[str, Any], label: str) -> Tuple[int, Any]:
+    """
+    POST a payload to the Perplexity API, retrying rate limits, server errors and network
+    failures with exponential backoff.
+
+    Args:
+        payload (Dict[str, Any]): The chat completion payload
+        label (str): Description of the call used in log messages
+
+    Returns:
+        Tuple[int, Any]: The HTTP status and the parsed JSON body on 200, or the raw error text otherwise
+
+    Raises:
+        aiohttp.ClientError, asyncio.TimeoutError: If the request still fails after MAX_RETRIES attempts
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    response_content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-                    
-                    json_start = response_content.find('{')
-                    json_end = response_content.rfind('}') + 1
-                    
-                    if json_start != -1 and json_end != -1:
-                        json_str = response_content[json_start:json_end]
-                        try:
-                            extracted_data = json.loads(json_str)
-                            return {
-                                "product": extracted_data.get("product", ""),
-                                "origin": extracted_data.get("origin", ""),
-                                "destination": extracted_data.get("destination", "")
-                            }
-                        except json.JSONDecodeError:
-                            logger.error(f"Failed to decode JSON from Perplexity extraction: {json_str}")
-                            return {"product": "", "origin": "", "destination": ""}
-                    else:
-                        logger.error(f"No JSON found in Perplexity extraction response: {response_content}")
-                        return {"product": "", "origin": "", "destination": ""}
-
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Error querying Perplexity API for info extraction: {error_text}")
-                    return {"product": "", "origin": "", "destination": ""}
-    except Exception as e:
-        logger.error(f"Exception while extracting info from user question: {str(e)}")
-        return {"product": "", "origin": "", "destination": ""}
+        return await _send_perplexity_attempt(payload, label)
+    except RetryableStatusError as e:
+        return e.status, e.text
 
-async def query_perplexity(domain: str, product: str, origin: str, destination: str) -> Dict[str, Any]:
+def _has_certification_list(body: Any) -> bool:
+    """
+    Return True if a chat completion's message content parses as a JSON array.
+    """
+    try:
+        content = body["choices"][0]["message"]["content"]
+        return isinstance(loads_llm_json(content, "["), list)
+    except (KeyError, IndexError, TypeError, json.JSONDecodeError):
+        return False
+
+async def query_perplexity(domain: str, product: str, origin: str, destination: str, include_citations: bool = False) -> Dict[str, Any]:
     """
     Query the Perplexity API for regulatory certifications for a given domain.
     
@@ -104,153 +558,384 @@ async def query_perplexity(domain: str, product: str, origin: str, destination:
         product (str): Name of the product to export
         origin (str): Country of origin
         destination (str): Destination country
+        include_citations (bool): Ask Perplexity to include its search results in the response
         
     Returns:
         Dict[str, Any]: The response from Perplexity API
     """
-    url = "https://api.perplexity.ai/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
     payload = {
-        "model": "sonar-pro",
-        "temperature": 0.2,
+        **CERTIFICATION_PAYLOAD_BASE,
         "messages": [
-            {
-                "role": "system",
-                "content": "You are a global trade compliance assistant. Respond only with official and verifiable regulatory data from trusted sources (e.g., Eur-Lex, FDA, DGFT, WTO, etc.). Format your response strictly as JSON. Do not include commentary, markdown, or assumptions. Only output the final structured JSON."
-            },
+            CERTIFICATION_SYSTEM_MESSAGE,
             {
                 "role": "user",
-                "content": f"Identify all certifications, licenses, and regulatory approvals required to legally export the product {product} from {origin} and sell or distribute it in {destination}. For each requirement, return the following fields:\n"
-                          f"- certificate_name: The name of the certification or license\n"
-                          f"- certificate_description: A short explanation of what the certificate is and why it's required\n"
-                          f"- legal_regulation: The name and article of the law or directive that mandates this (e.g., Regulation (EC) No 1223/2009, Article 19)\n"
-                          f"- legal_text_excerpt: An exact quote (1–2 lines) from the regulation\n"
-                          f"- legal_text_meaning: A simplified explanation of the quoted text\n"
-                          f"- registration_fee: The official registration or filing fee, if publicly available (include currency and link if possible and convert to approximate USD (e.g., 'INR 500 (~$6.00 USD)'))\n"
-                          f"Return the result as a JSON array using exactly these field names: certificate_name, certificate_description, legal_regulation, legal_text_excerpt, legal_text_meaning, registration_fee"
+                "content": CERTIFICATION_USER_PROMPT_TEMPLATE.format(product=product, origin=origin, destination=destination)
             }
         ],
         "search_domain_filter": [domain],
-        "include_search_results": True
+        "include_search_results": include_citations
     }
+
+    use_cache = is_cacheable(payload)
+    if use_cache:
+        cache_key = make_cache_key("pplx", PROMPT_VERSION, payload["model"], payload["messages"], domain, include_citations)
+        cached = await _cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached Perplexity response for domain %s", domain)
+            return cached
     
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return {
-                        "domain": domain,
-                        "product": product,
-                        "origin": origin,
-                        "destination": destination,
-                        "response": result
-                    }
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Error querying Perplexity API for domain {domain}: {error_text}")
-                    return {
-                        "domain": domain,
-                        "product": product,
-                        "origin": origin,
-                        "destination": destination,
-                        "error": f"API request failed with status {response.status}",
-                        "details": error_text
-                    }
-    except Exception as e:
-        logger.error(f"Exception while querying Perplexity API for domain {domain}: {str(e)}")
-        return {
+    async def fetch() -> Dict[str, Any]:
+        try:
+            status, body = await _post_perplexity(payload, f"domain {domain}")
+            if status == 200:
+                domain_result = {
+                    "domain": domain,
+                    "product": product,
+                    "origin": origin,
+                    "destination": destination,
+                    "response": body
+                }
+                # Only cache answers that hold a certification list, not prose or an error object
+                if use_cache and _has_certification_list(body):
+                    await _cache.set(cache_key, domain_result)
+                return domain_result
+            else:
+                logger.error("Error querying Perplexity API for domain %s: %s", domain, body)
+                return {
+                    "domain": domain,
+                    "product": product,
+                    "origin": origin,
+                    "destination": destination,
+                    "error": f"API request failed with status {status}",
+                    "details": body
+                }
+        except Exception as e:
+            logger.error("Exception while querying Perplexity API for domain %s: %s", domain, e)
+            return {
+                "domain": domain,
+                "product": product,
+                "origin": origin,
+                "destination": destination,
+                "error": "Request failed",
+                "details": str(e)
+            }
+
+    if not use_cache:
+        return await fetch()
+    # Concurrent searches for the same domain share one query, including its cache write
+    return await _single_flight(cache_key, fetch)
+
+async def query_perplexity_batch(domains: List[str], product: str, origin: str, destination: str, include_citations: bool = False) -> List[Dict[str, Any]]:
+    """
+    Query the Perplexity API for regulatory certifications across several domains in a single call.
+
+    The model is asked for a JSON object mapping each domain to its requirements, which is split
+    back into one result per domain in the same shape query_perplexity returns. If the combined
+    answer cannot be split, because a requested domain is missing or its value is not a list,
+    the domains are queried individually instead and nothing is cached for the batch.
+
+    Args:
+        domains (List[str]): The domains to search
+        product (str): Name of the product to export
+        origin (str): Country of origin
+        destination (str): Destination country
+        include_citations (bool): Ask Perplexity to include its search results, which are then attached to every domain's result
+
+    Returns:
+        List[Dict[str, Any]]: One result per domain, in the order given
+    """
+    if len(domains) == 1:
+        return [await query_perplexity(domains[0], product, origin, destination, include_citations)]
+
+    payload = {
+        **CERTIFICATION_PAYLOAD_BASE,
+        "messages": [
+            CERTIFICATION_SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": BATCH_CERTIFICATION_USER_PROMPT_TEMPLATE.format(
+                    product=product,
+                    origin=origin,
+                    destination=destination,
+                    domains=", ".join(domains)
+                )
+            }
+        ],
+        "search_domain_filter": domains,
+        "include_search_results": include_citations
+    }
+
+    label = f"domains {', '.join(domains)}"
+    use_cache = is_cacheable(payload)
+    if use_cache:
+        cache_key = make_cache_key("pplx-batch", PROMPT_VERSION, payload["model"], payload["messages"], domains, include_citations)
+        cached = await _cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached Perplexity response for %s", label)
+            return cached
+
+    async def fetch() -> List[Dict[str, Any]]:
+        try:
+            status, body = await _post_perplexity(payload, label)
+        except Exception as e:
+            logger.error("Exception while querying Perplexity API for %s: %s", label, e)
+            return [
+                {
+                    "domain": domain,
+                    "product": product,
+                    "origin": origin,
+                    "destination": destination,
+                    "error": "Request failed",
+                    "details": str(e)
+                }
+                for domain in domains
+            ]
+
+        if status != 200:
+            logger.error("Error querying Perplexity API for %s: %s", label, body)
+            return [
+                {
+                    "domain": domain,
+                    "product": product,
+                    "origin": origin,
+                    "destination": destination,
+                    "error": f"API request failed with status {status}",
+                    "details": body
+                }
+                for domain in domains
+            ]
+
+        # Any malformed reply (no choices, null content, bad JSON) is just unsplittable
+        try:
+            response_content = body["choices"][0]["message"]["content"]
+            certs_by_domain = _split_batch_reply(loads_llm_json(response_content, "{"), domains)
+        except Exception as e:
+            logger.debug("Malformed batched Perplexity response for %s: %s", label, e)
+            certs_by_domain = None
+
+        if certs_by_domain is None:
+            logger.warning("Could not split batched Perplexity response for %s, querying domains individually", label)
+            return list(await asyncio.gather(*(query_perplexity(domain, product, origin, destination, include_citations) for domain in domains)))
+
+        # Re-wrap each domain's certifications as a single-domain chat completion
+        results = []
+        for domain in domains:
+            certs = certs_by_domain[domain]
+            domain_response: Dict[str, Any] = {"choices": [{"message": {"content": orjson.dumps(certs).decode()}}]}
+            if include_citations:
+                domain_response["search_results"] = body.get("search_results", [])
+            results.append({
+                "domain": domain,
+                "product": product,
+                "origin": origin,
+                "destination": destination,
+                "response": domain_response
+            })
+        if use_cache:
+            await _cache.set(cache_key, results)
+        return results
+
+    if not use_cache:
+        return await fetch()
+    # Concurrent searches for the same batch share one query, including its cache write
+    return await _single_flight(cache_key, fetch)
+
+async def _resolve_search_fields(
+    user_question: Optional[str],
+    product: Optional[str],
+    origin: Optional[str],
+    destination: Optional[str],
+    connections_needed: int = 0
+) -> Tuple[str, str, str]:
+    """
+    Fill in product, origin, and destination from the user question where they aren't given explicitly.
+
+    While extraction runs, connections_needed connections for the following queries are warmed up.
+    """
+    if not (product and origin and destination) and user_question:
+        logger.info("Extracting product, origin, and destination from: %s", user_question)
+        warm_connections(connections_needed)
+        extracted_info = await extract_info_from_question(user_question)
+        product = product or extracted_info.get("product", "")
+        origin = origin or extracted_info.get("origin", "")
+        destination = destination or extracted_info.get("destination", "")
+    return product or "", origin or "", destination or ""
+
+def _missing_fields_results(
+    domains: List[str],
+    user_question: Optional[str],
+    product: str,
+    origin: str,
+    destination: str
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Return an error result per domain if product, origin, or destination is still empty, else None.
+
+    Querying with an empty field only wastes a Perplexity call per batch, so searches that
+    can't name all three are answered without any.
+    """
+    missing = [name for name, value in (("product", product), ("origin", origin), ("destination", destination)) if not value]
+    if not missing:
+        return None
+
+    logger.warning("Could not extract %s from user question: '%s'. Skipping domain queries.", ", ".join(missing), user_question)
+    return [
+        {
             "domain": domain,
             "product": product,
             "origin": origin,
             "destination": destination,
-            "error": "Request failed",
-            "details": str(e)
+            "error": MISSING_FIELDS_ERROR,
+            "details": f"Could not determine {', '.join(missing)}"
         }
+        for domain in domains
+    ]
+
+def _batch_domains(domains: List[str]) -> List[List[str]]:
+    """
+    Split domains into consecutive batches of at most PPLX_BATCH_SIZE, or a single batch if it is 0.
+    """
+    if PPLX_BATCH_SIZE <= 0:
+        return [domains] if domains else []
+    return [domains[i:i + PPLX_BATCH_SIZE] for i in range(0, len(domains), PPLX_BATCH_SIZE)]
 
-async def process_domains(domains: List[str], user_question: str) -> List[Dict[str, Any]]:
+async def process_domains(
+    domains: List[str],
+    user_question: Optional[str] = None,
+    product: Optional[str] = None,
+    origin: Optional[str] = None,
+    destination: Optional[str] = None
+) -> List[Dict[str, Any]]:
     """
     Process multiple domains in parallel using the Perplexity API,
     extracting product, origin, and destination from the user question.
+    Explicitly given product, origin, or destination values take precedence,
+    and extraction is skipped when all three are given.
+    Domains are queried in batches of PPLX_BATCH_SIZE per API call (all at once if it is 0).
+    Results are returned in the order of domains once every batch has finished.
+    If product, origin, or destination can't be determined, no domains are queried and
+    every domain gets a MISSING_FIELDS_ERROR result instead. ExtractionError propagates if
+    the extraction call itself fails.
     """
-    logger.info(f"Extracting product, origin, and destination from: {user_question}")
-    extracted_info = await extract_info_from_question(user_question)
-    product = extracted_info.get("product", "")
-    origin = extracted_info.get("origin", "")
-    destination = extracted_info.get("destination", "")
-    
-    if not (product and origin and destination):
-        logger.warning(f"Could not extract all required information (product, origin, destination) from user question: '{user_question}'. Proceeding with available info.")
+    batches = _batch_domains(domains)
+    product, origin, destination = await _resolve_search_fields(user_question, product, origin, destination, len(batches))
+    missing_results = _missing_fields_results(domains, user_question, product, origin, destination)
+    if missing_results is not None:
+        return missing_results
 
-    tasks = [query_perplexity(domain, product, origin, destination) for domain in domains]
-    return await asyncio.gather(*tasks)
+    batch_results = await asyncio.gather(
+        *(query_perplexity_batch(batch, product, origin, destination) for batch in batches)
+    )
+    return [result for batch_result in batch_results for result in batch_result]
+
+async def process_domains_iter(
+    domains: List[str],
+    user_question: Optional[str] = None,
+    product: Optional[str] = None,
+    origin: Optional[str] = None,
+    destination: Optional[str] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Like process_domains, but yields each domain's result as soon as its batch completes,
+    so callers can start on the fastest domains without waiting for the slowest.
+    Results arrive in completion order, not the order of domains.
+    """
+    batches = _batch_domains(domains)
+    product, origin, destination = await _resolve_search_fields(user_question, product, origin, destination, len(batches))
+    missing_results = _missing_fields_results(domains, user_question, product, origin, destination)
+    if missing_results is not None:
+        for result in missing_results:
+            yield result
+        return
+
+    tasks = [
+        asyncio.create_task(query_perplexity_batch(batch, product, origin, destination))
+        for batch in batches
+    ]
+    try:
+        for next_batch in asyncio.as_completed(tasks):
+            for result in await next_batch:
+                yield result
+    finally:
+        # Don't leave queries running if the caller stops iterating early
+        for task in tasks:
+            task.cancel()
 
 async def deduplicate_certifications_with_llm(certifications: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Deduplicates a list of certifications using Perplexity AI to identify and consolidate similar entries.
+
+    Certificates are first grouped by normalized name. If every name is distinct the list is returned
+    without calling the LLM; otherwise only the certificates whose names collide are sent for consolidation.
     """
-    url = "https://api.perplexity.ai/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    if len(certifications) < 2:
+        return certifications
 
-    # Prepare the list of certifications as a string for the LLM
-    certs_str = json.dumps(certifications, indent=2)
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for cert in certifications:
+        name_key = re.sub(r'\s+', ' ', str(cert.get('certificate_name', '')).strip().lower())
+        groups.setdefault(name_key, []).append(cert)
 
-    messages = [
-        {
-            "role": "system",
-            "content": "You are an expert in regulatory compliance and data consolidation. Your task is to review a list of certification requirements, identify and consolidate similar or duplicate certifications based on their 'certificate_name' and 'certificate_description'. For each unique certification, provide one comprehensive entry. If there are variations for the same certificate, use the most detailed and representative information. Ensure the output is a JSON array of unique certification objects, maintaining all original field names: 'certificate_name', 'certificate_description', 'legal_regulation', 'legal_text_excerpt', 'legal_text_meaning', 'registration_fee', and 'domain'. Do not include any other text, commentary, or markdown outside the JSON."
-        },
-        {
-            "role": "user",
-            "content": f"Here is the list of certifications:\n\n{certs_str}\n\nConsolidate and return only the unique certifications."
-        }
+    if len(groups) == len(certifications):
+        logger.info("All certificate names are distinct, skipping LLM deduplication")
+        return certifications
+
+    unique_certs = [group[0] for group in groups.values() if len(group) == 1]
+    colliding_certs = [cert for group in groups.values() if len(group) > 1 for cert in group]
+
+    # Used if the LLM call fails: keep the most detailed entry for each colliding name
+    fallback_certs = unique_certs + [
+        max(group, key=lambda cert: len(str(cert.get('certificate_description', ''))))
+        for group in groups.values() if len(group) > 1
     ]
 
     payload = {
-        "model": "sonar-pro",
-        "temperature": 0.1, # Keep temperature low for more deterministic results
-        "messages": messages,
-        "include_search_results": False
+        **DEDUPLICATION_PAYLOAD_BASE,
+        "messages": [
+            DEDUPLICATION_SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": DEDUPLICATION_USER_PROMPT_TEMPLATE.format(certifications=orjson.dumps(colliding_certs).decode())
+            }
+        ]
     }
 
+    # Key on the certificates regardless of the order the domains returned them in
+    use_cache = is_cacheable(payload)
+    if use_cache:
+        cache_key = make_cache_key(
+            "dedup",
+            PROMPT_VERSION,
+            payload["model"],
+            sorted(orjson.dumps(cert, option=orjson.OPT_SORT_KEYS).decode() for cert in colliding_certs)
+        )
+        cached = await _cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached deduplication result")
+            return unique_certs + cached
+
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    response_content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-                    
-                    # Attempt to find JSON within the response content
-                    json_start = response_content.find('[') # Expecting a JSON array
-                    json_end = response_content.rfind(']') + 1
-                    
-                    if json_start != -1 and json_end != -1:
-                        json_str = response_content[json_start:json_end]
-                        try:
-                            deduplicated_certs = json.loads(json_str)
-                            if isinstance(deduplicated_certs, list):
-                                return deduplicated_certs
-                            else:
-                                logger.error(f"Perplexity returned non-list JSON for deduplication: {json_str}")
-                                return certifications # Return original if not a list
-                        except json.JSONDecodeError:
-                            logger.error(f"Failed to decode JSON from Perplexity deduplication: {json_str}")
-                            return certifications # Return original on decode error
-                    else:
-                        logger.error(f"No JSON array found in Perplexity deduplication response: {response_content}")
-                        return certifications # Return original if no JSON found
-
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Error querying Perplexity API for deduplication: {error_text}")
-                    return certifications # Return original on API error
+        status, result = await _post_perplexity(payload, "deduplication")
+        if status == 200:
+            response_content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
+                
+            try:
+                deduplicated_certs = loads_llm_json(response_content, "[") # Expecting a JSON array
+            except json.JSONDecodeError:
+                logger.error("No JSON array found in Perplexity deduplication response: %s", response_content)
+                return fallback_certs # Fall back if no JSON found
+
+            if isinstance(deduplicated_certs, list):
+                if use_cache:
+                    await _cache.set(cache_key, deduplicated_certs)
+                return unique_certs + deduplicated_certs
+            else:
+                logger.error("Perplexity returned non-list JSON for deduplication: %s", response_content)
+                return fallback_certs # Fall back if not a list
+
+        else:
+            logger.error("Error querying Perplexity API for deduplication: %s", result)
+            return fallback_certs # Fall back on API error
     except Exception as e:
-        logger.error(f"Exception while deduplicating certifications: {str(e)}")
-        return certifications # Return original on exception 
\ No newline at end of file
+        logger.error("Exception while deduplicating certifications: %s", e)
+        return fallback_certs # Fall back on exception 
\ No newline at end of file